@@ -2,6 +2,7 @@
 # copyright notices and license terms.
 from trytond.pool import Pool
 from . import configuration
+from . import ir
 from . import milestone
 from . import work
 from . import invoice
@@ -9,13 +10,25 @@ from . import invoice
 
 def register():
     Pool.register(
+        ir.Sequence,
         configuration.Configuration,
         milestone.MilestoneTypeGroup,
         milestone.MilestoneType,
         milestone.Milestone,
+        milestone.MilestoneTriggerQueue,
+        milestone.MilestoneCronCheckpoint,
+        milestone.MilestoneJob,
+        milestone.ForecastStart,
+        milestone.ForecastResult,
+        milestone.ForecastLine,
         work.Work,
         work.WorkInvoicedProgress,
+        work.CreateMilestonesStart,
         invoice.Invoice,
-        invoice.InvoiceMilestoneRelation,
         invoice.InvoiceLine,
         module='project_invoice_milestone', type_='model')
+    Pool.register(
+        milestone.Forecast,
+        work.CheckCompensationLedger,
+        work.CreateMilestones,
+        module='project_invoice_milestone', type_='wizard')
@@ -1,9 +1,16 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+from weakref import WeakKeyDictionary
+
 from trytond.model import ModelView, ModelSQL, ModelSingleton, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
 
 __all_ = ['Configuration']
 
+# Configuration and company defaults cached by transaction
+_cache = WeakKeyDictionary()
+
 
 class Configuration(ModelSingleton, ModelSQL, ModelView):
     'Project Invoice Milestone Configuration'
@@ -17,3 +24,91 @@ class Configuration(ModelSingleton, ModelSQL, ModelView):
         'Default Advancement Product')
     compensation_product = fields.Many2One('product.product',
         'Default Compensation Product')
+    consolidate_invoices = fields.Boolean('Consolidate Invoices',
+        help='Invoice together the milestones with the same party, company, '
+        'currency, payment term and invoice date.')
+    invoice_in_background = fields.Boolean('Invoice in Background',
+        help='The Check Triggers and Invoice buttons of milestones and the '
+        'Open and Done buttons of projects enqueue jobs which are run later '
+        'by a cron, instead of invoicing at once.')
+    trigger_processes = fields.Integer('Trigger Processes',
+        domain=[
+            ['OR',
+                ('trigger_processes', '=', None),
+                ('trigger_processes', '>=', 1),
+                ],
+            ],
+        help='If set, the cron checks the milestone triggers of each project '
+        'in its own transaction, distributed among this number of '
+        'processes.')
+    trigger_chunk_size = fields.Integer('Trigger Chunk Size',
+        domain=[
+            ['OR',
+                ('trigger_chunk_size', '=', None),
+                ('trigger_chunk_size', '>=', 1),
+                ],
+            ],
+        help='The number of milestones checked by the cron before committing '
+        'its progress. Leave empty to check all of them at once.')
+    trigger_time_budget = fields.Integer('Trigger Time Budget',
+        domain=[
+            ['OR',
+                ('trigger_time_budget', '=', None),
+                ('trigger_time_budget', '>=', 1),
+                ],
+            ],
+        help='The seconds after which the cron stops checking milestone '
+        'triggers. The next run resumes from where it stopped.')
+
+    @classmethod
+    def get_cached(cls):
+        "Return the configuration, cached for the transaction"
+        transaction = Transaction()
+        cache = _cache.setdefault(transaction, {})
+        key = ('configuration', transaction.context.get('company'))
+        if key not in cache:
+            cache[key] = cls(1)
+        return cache[key]
+
+    @classmethod
+    def get_milestone_defaults(cls):
+        """Return a dictionary with the default advancement_product,
+        compensation_product, currency and currency_digits of milestones,
+        cached for the transaction."""
+        pool = Pool()
+        Company = pool.get('company.company')
+        transaction = Transaction()
+        company_id = transaction.context.get('company')
+        cache = _cache.setdefault(transaction, {})
+        key = ('milestone_defaults', company_id)
+        if key not in cache:
+            config = cls.get_cached()
+            defaults = {
+                'advancement_product': (config.advancement_product.id
+                    if config.advancement_product else None),
+                'compensation_product': (config.compensation_product.id
+                    if config.compensation_product else None),
+                'currency': None,
+                'currency_digits': 2,
+                }
+            if company_id:
+                currency = Company(company_id).currency
+                defaults['currency'] = currency.id
+                defaults['currency_digits'] = currency.digits
+            cache[key] = defaults
+        return cache[key]
+
+    @classmethod
+    def create(cls, vlist):
+        _cache.pop(Transaction(), None)
+        return super(Configuration, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        _cache.pop(Transaction(), None)
+        super(Configuration, cls).write(*args)
+
+    @classmethod
+    def delete(cls, configurations):
+        _cache.pop(Transaction(), None)
+        super(Configuration, cls).delete(configurations)
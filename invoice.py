@@ -2,25 +2,23 @@
 # copyright notices and license terms.
 import itertools
 
-from trytond.model import ModelSQL, fields, Unique
+from trytond.model import fields
 from trytond.pool import PoolMeta, Pool
-from trytond.pyson import Eval
-from trytond.tools import grouped_slice
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
 
-__all__ = ['Invoice', 'InvoiceMilestoneRelation', 'InvoiceLine']
+__all__ = ['Invoice', 'InvoiceLine']
 
 
 class Invoice:
     __name__ = 'account.invoice'
     __metaclass__ = PoolMeta
 
-    project_milestone = fields.One2One(
-        'account.invoice-project.invoice_milestone',
-        'invoice', 'milestone', 'Milestone', domain=[
-            ('project_company', '=', Eval('company', -1)),
-            ('project_party', '=', Eval('party', -1)),
-            ],
-        readonly=True, depends=['company', 'party'])
+    project_milestone = fields.Function(fields.Many2One(
+            'project.invoice_milestone', 'Milestone'),
+        'get_project_milestone', searcher='search_project_milestone')
+    project_milestones = fields.One2Many('project.invoice_milestone',
+        'invoice', 'Milestones', readonly=True)
 
     @classmethod
     def __setup__(cls):
@@ -69,6 +67,8 @@ class Invoice:
             winvprog_to_create = []
             for new_inv in new_invoices:
                 for new_inv_line in new_inv.lines:
+                    if not new_inv_line.origin:
+                        continue
                     for new_winvprog in inv_line2winvprog.get(
                                 new_inv_line.origin.id, []):
                         new_winvprog.invoice_line = new_inv_line
@@ -77,25 +77,87 @@ class Invoice:
                 WorkInvoicedProgress.save(winvprog_to_create)
         # END part to move to project_invoice
 
-        milestones_to_create = []
+        invoice_milestones = cls._get_project_milestones(invoices)
+        credits = []
         for invoice, new_invoice in itertools.izip(invoices, new_invoices):
-            if invoice.project_milestone:
-                milestones_to_create.append(
-                    invoice.project_milestone._credit(new_invoice))
-
-        if milestones_to_create:
-            Milestone.save(milestones_to_create)
-            Milestone.confirm(milestones_to_create)
-            Milestone.invoiced(milestones_to_create)
+            for milestone in invoice_milestones.get(invoice.id, []):
+                credits.append((milestone, new_invoice))
+        Milestone.create_credits(credits)
+        cls._update_compensation_ledger(new_invoices)
         return new_invoices
 
+    @classmethod
+    def get_project_milestone(cls, invoices, name):
+        invoice_milestones = cls._get_project_milestones(invoices)
+        return dict((i.id, invoice_milestones[i.id][0].id
+                if i.id in invoice_milestones else None)
+            for i in invoices)
+
+    @classmethod
+    def search_project_milestone(cls, name, clause):
+        return [('project_milestones',) + tuple(clause[1:])]
+
+    @classmethod
+    def _get_project_milestones(cls, invoices):
+        """Return a dictionary with the milestones of each invoice id, read
+        with one query per slice of invoices.
+        The invoices without milestones are not included."""
+        pool = Pool()
+        Milestone = pool.get('project.invoice_milestone')
+        milestone = Milestone.__table__()
+        cursor = Transaction().connection.cursor()
+
+        milestone_ids = {}
+        for sub_ids in grouped_slice([i.id for i in invoices]):
+            cursor.execute(*milestone.select(
+                    milestone.invoice, milestone.id,
+                    where=reduce_ids(milestone.invoice, sub_ids),
+                    order_by=milestone.id))
+            for invoice_id, milestone_id in cursor.fetchall():
+                milestone_ids.setdefault(invoice_id, []).append(milestone_id)
+        if not milestone_ids:
+            return {}
+        milestones = dict((m.id, m) for m in Milestone.browse(
+                sum(milestone_ids.values(), [])))
+        return dict((i, [milestones[m] for m in ids])
+            for i, ids in milestone_ids.iteritems())
+
+    @classmethod
+    def _update_compensation_ledger(cls, invoices, invoice_milestones=None):
+        "Update the compensation ledger of the projects of invoices"
+        Work = Pool().get('project.work')
+        if invoice_milestones is None:
+            invoice_milestones = cls._get_project_milestones(invoices)
+        projects = set(m.project for ms in invoice_milestones.itervalues()
+            for m in ms)
+        if projects:
+            Work.update_compensation_ledger(list(projects))
+
+    @classmethod
+    def update_taxes(cls, invoices, exception=False):
+        super(Invoice, cls).update_taxes(invoices, exception=exception)
+        cls._update_compensation_ledger(invoices)
+
+    @classmethod
+    def post(cls, invoices):
+        super(Invoice, cls).post(invoices)
+        cls._update_compensation_ledger(invoices)
+
+    @classmethod
+    def cancel(cls, invoices):
+        super(Invoice, cls).cancel(invoices)
+        cls._update_compensation_ledger(invoices)
+
     @classmethod
     def draft(cls, invoices):
+        invoice_milestones = cls._get_project_milestones(invoices)
         for invoice in invoices:
-            if invoice.state == 'cancel' and invoice.project_milestone:
+            if invoice.state == 'cancel' and invoice.id in invoice_milestones:
                 cls.raise_user_error('reset_invoice_milestone')
 
-        return super(Invoice, cls).draft(invoices)
+        result = super(Invoice, cls).draft(invoices)
+        cls._update_compensation_ledger(invoices, invoice_milestones)
+        return result
 
     @classmethod
     def copy(cls, invoices, default=None):
@@ -103,37 +165,21 @@ class Invoice:
             default = {}
         else:
             default = default.copy()
-        default['milestone'] = None
+        default['project_milestones'] = None
         return super(Invoice, cls).copy(invoices, default=default)
 
     @classmethod
     def delete(cls, invoices):
         pool = Pool()
         Milestone = pool.get('project.invoice_milestone')
-        milestones = [i.project_milestone for i in invoices
-                if i.project_milestone]
+        Work = pool.get('project.work')
+        milestones = sum(cls._get_project_milestones(invoices).values(), [])
         super(Invoice, cls).delete(invoices)
+        if not milestones:
+            return
         Milestone.cancel(milestones)
-
-
-class InvoiceMilestoneRelation(ModelSQL):
-    'Invoice - Project Invoice Milestone'
-    __name__ = 'account.invoice-project.invoice_milestone'
-    invoice = fields.Many2One('account.invoice', 'Invoice', ondelete='CASCADE',
-        required=True, select=True)
-    milestone = fields.Many2One('project.invoice_milestone', 'Milestone',
-        ondelete='CASCADE', required=True, select=True)
-
-    @classmethod
-    def __setup__(cls):
-        super(InvoiceMilestoneRelation, cls).__setup__()
-        t = cls.__table__()
-        cls._sql_constraints += [
-            ('invoice_unique', Unique(t, t.invoice),
-                'The Invoice must be unique.'),
-            ('milestone_unique', Unique(t, t.milestone),
-                'The Milestone must be unique.'),
-            ]
+        Work.update_compensation_ledger(
+            list(set(m.project for m in milestones)))
 
 
 class InvoiceLine:
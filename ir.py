@@ -0,0 +1,47 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond import backend
+from trytond.pool import PoolMeta
+from trytond.transaction import Transaction
+
+__all__ = ['Sequence']
+
+
+class Sequence:
+    __metaclass__ = PoolMeta
+    __name__ = 'ir.sequence'
+
+    @classmethod
+    def reserve_numbers(cls, sequence, count):
+        """Return count numbers of the incremental sequence reserved at once.
+        Other sequence types get each number with get_id."""
+        transaction = Transaction()
+        if not count:
+            return []
+        with transaction.set_context(user=False, _check_access=False), \
+                transaction.set_user(0):
+            sequence = cls(sequence.id)
+            if sequence.type != 'incremental':
+                return [cls.get_id(sequence.id) for _ in range(count)]
+
+            if backend.name() == 'postgresql':
+                cursor = transaction.connection.cursor()
+                cursor.execute('SELECT nextval(%s) '
+                    'FROM generate_series(1, %s)',
+                    (sequence._sql_sequence_name, count))
+                values = [v for v, in cursor.fetchall()]
+            else:
+                number_next = sequence.number_next_internal
+                values = [number_next + i * sequence.number_increment
+                    for i in range(count)]
+                cls.write([sequence], {
+                        'number_next_internal': (
+                            number_next + count * sequence.number_increment),
+                        })
+
+            # Same date as get_id for the date placeholders
+            date = transaction.context.get('date')
+            prefix = cls._process(sequence.prefix, date=date)
+            suffix = cls._process(sequence.suffix, date=date)
+            return ['%s%s%s' % (prefix, '%%0%sd' % sequence.padding % value,
+                    suffix) for value in values]
@@ -1,15 +1,31 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import logging
+import time
+import traceback
+from collections import namedtuple, OrderedDict
+from threading import Lock
+from multiprocessing import Pool as ProcessPool
+from sql import Table
+from sql.aggregate import Count
+
+from trytond import backend
+from trytond.config import config
 from trytond.model import Workflow, ModelSQL, ModelView, fields
 from trytond.pool import Pool
 from trytond.pyson import Bool, Eval, If
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateView, Button
 from dateutil.relativedelta import relativedelta
-from decimal import Decimal
+from decimal import Decimal, ROUND_HALF_EVEN
 from itertools import groupby
-from jinja2 import Template as Jinja2Template
+from jinja2.sandbox import SandboxedEnvironment
 
-__all__ = ['MilestoneTypeGroup', 'MilestoneType', 'Milestone']
+__all__ = ['MilestoneTypeGroup', 'MilestoneType', 'Milestone',
+    'MilestoneTriggerQueue', 'MilestoneCronCheckpoint', 'MilestoneJob',
+    'ForecastStart',
+    'ForecastResult', 'ForecastLine', 'Forecast']
 
 _KIND = [
     ('manual', 'Manual'),
@@ -22,6 +38,80 @@ _TRIGGER = [
     ('finish_project', 'On Project Finish'),
     ]
 _ZERO = Decimal('0.0')
+# Fields of the invoice date calculator
+_DELTA_FIELDS = {'months', 'month', 'weeks', 'weekday', 'days', 'day'}
+
+MilestoneForecast = namedtuple('MilestoneForecast', ['milestone', 'project',
+        'invoice_date', 'amount', 'compensation'])
+
+logger = logging.getLogger(__name__)
+
+# Connections inherited from the coordinator process by the forked workers.
+# They are kept referenced so they are never closed by the worker, which
+# would close the socket shared with the coordinator.
+_inherited_databases = []
+
+
+class _TemplateCache(object):
+    "Least recently used cache of compiled templates by their text"
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._environment = SandboxedEnvironment()
+        self._templates = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, text):
+        with self._lock:
+            template = self._templates.pop(text, None)
+            if template is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                template = self._environment.from_string(text)
+            self._templates[text] = template
+            if len(self._templates) > self.size:
+                self._templates.popitem(last=False)
+            return template
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+            self.hits = self.misses = 0
+
+
+template_cache = _TemplateCache(config.getint('project_invoice_milestone',
+        'template_cache_size', default=128))
+
+
+def _init_trigger_worker():
+    "Force the forked worker to open its own database connections"
+    Database = backend.get('Database')
+    databases = getattr(Database, '_databases', None)
+    if databases:
+        _inherited_databases.append(dict(databases))
+        databases.clear()
+
+
+def _check_trigger_shard(args):
+    """Check the triggers and invoice the milestones of one shard in its own
+    transaction.
+    Return the milestone ids of the shard and the error, if any."""
+    database_name, user, context, milestone_ids = args
+    with Transaction(new=True).start(database_name, user,
+            context=context) as transaction:
+        Milestone = Pool().get('project.invoice_milestone')
+        try:
+            Milestone.check_trigger(Milestone.browse(milestone_ids))
+            transaction.commit()
+        except Exception:
+            transaction.rollback()
+            logger.error('Error checking triggers of milestones %s',
+                milestone_ids, exc_info=True)
+            return milestone_ids, traceback.format_exc()
+    return milestone_ids, None
 
 
 class MilestoneMixin:
@@ -141,36 +231,23 @@ class MilestoneMixin:
 
     @staticmethod
     def default_advancement_product():
-        pool = Pool()
-        Config = pool.get('project.invoice_milestone.configuration')
-        config = Config.get_singleton()
-        if getattr(config, 'advancement_product', None):
-            return config.advancement_product.id
+        Config = Pool().get('project.invoice_milestone.configuration')
+        return Config.get_milestone_defaults()['advancement_product']
 
     @staticmethod
     def default_compensation_product():
-        pool = Pool()
-        Config = pool.get('project.invoice_milestone.configuration')
-        config = Config.get_singleton()
-        if config and config.compensation_product:
-            return config.compensation_product.id
+        Config = Pool().get('project.invoice_milestone.configuration')
+        return Config.get_milestone_defaults()['compensation_product']
 
     @staticmethod
     def default_currency():
-        pool = Pool()
-        Company = pool.get('company.company')
-        company_id = Transaction().context.get('company')
-        if company_id:
-            return Company(company_id).currency.id
+        Config = Pool().get('project.invoice_milestone.configuration')
+        return Config.get_milestone_defaults()['currency']
 
     @staticmethod
     def default_currency_digits():
-        pool = Pool()
-        Company = pool.get('company.company')
-        company_id = Transaction().context.get('company')
-        if company_id:
-            return Company(company_id).currency.digits
-        return 2
+        Config = Pool().get('project.invoice_milestone.configuration')
+        return Config.get_milestone_defaults()['currency_digits']
 
     @staticmethod
     def default_months():
@@ -220,6 +297,30 @@ class MilestoneTypeGroup(ModelSQL, ModelView):
             milestones.append(milestone)
         return milestones
 
+    @classmethod
+    def create_milestones(cls, project_groups):
+        """Create the milestones of the (project, group) pairs.
+        The lines of each group are read once and the milestones are created
+        in chunks."""
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Milestone = pool.get('project.invoice_milestone')
+
+        today = Date.today()
+        by_group = {}
+        for project, group in project_groups:
+            by_group.setdefault(group, []).append(project)
+        vlist = []
+        for group, projects in by_group.iteritems():
+            lines = group.lines
+            for project in projects:
+                for line in lines:
+                    vlist.append(line.get_milestone_values(project, today))
+        milestones = []
+        for sub_vlist in grouped_slice(vlist):
+            milestones += Milestone.create(list(sub_vlist))
+        return milestones
+
 
 class MilestoneType(ModelSQL, ModelView, MilestoneMixin):
     'Milestone Type'
@@ -239,30 +340,67 @@ class MilestoneType(ModelSQL, ModelView, MilestoneMixin):
         table, _ = tables[None]
         return [table.sequence == None, table.sequence]
 
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Milestone = pool.get('project.invoice_milestone')
+
+        super(MilestoneType, cls).write(*args)
+
+        to_write = []
+        actions = iter(args)
+        for types, values in zip(actions, actions):
+            delta_values = dict((f, v) for f, v in values.iteritems()
+                if f in _DELTA_FIELDS)
+            if not delta_values:
+                continue
+            for sub_types in grouped_slice(types):
+                milestones = Milestone.search([
+                        ('milestone_type', 'in', [t.id for t in sub_types]),
+                        ('state', '=', 'draft'),
+                        ])
+                if milestones:
+                    to_write.extend((milestones, delta_values))
+        if to_write:
+            Milestone.write(*to_write)
+
     def compute_milestone(self, project):
         pool = Pool()
         Milestone = pool.get('project.invoice_milestone')
+        return Milestone(**self.get_milestone_values(project))
+
+    def get_milestone_values(self, project, today=None):
+        "Return the values to create the milestone of the project"
+        pool = Pool()
+        Date = pool.get('ir.date')
 
-        milestone = Milestone()
-        milestone.project = project
-        milestone.kind = self.kind
-        milestone.invoice_percent = self.invoice_percent
+        if today is None:
+            today = Date.today()
+        values = {
+            'project': project.id,
+            'milestone_type': self.id,
+            'kind': self.kind,
+            'invoice_percent': self.invoice_percent,
+            'invoice_method': self.invoice_method,
+            }
         if self.kind == 'system':
-            milestone.trigger = self.trigger
-            milestone.trigger_progress = self.trigger_progress
-        milestone.invoice_method = self.invoice_method
+            values['trigger'] = self.trigger
+            values['trigger_progress'] = self.trigger_progress
         if self.invoice_method not in ['progress', 'remainder']:
-            milestone.advancement_product = self.advancement_product
-            milestone.advancement_amount = self.advancement_amount
-            milestone.currency = self.currency
+            values['advancement_product'] = (self.advancement_product.id
+                if self.advancement_product else None)
+            values['advancement_amount'] = self.advancement_amount
+            values['currency'] = self.currency.id if self.currency else None
         if self.invoice_method not in ['percent']:
-            milestone.compensation_product = self.compensation_product
+            values['compensation_product'] = (self.compensation_product.id
+                if self.compensation_product else None)
 
         for fname in ('months', 'month', 'weeks', 'weekday', 'days', 'day',
                 'description'):
-            setattr(milestone, fname, getattr(self, fname))
-        # invoice_date, planned_invoice_date
-        return milestone
+            values[fname] = getattr(self, fname)
+        values['planned_invoice_date'] = today + relativedelta(
+            **self._calc_delta())
+        return values
 
 
 class Milestone(Workflow, ModelSQL, ModelView, MilestoneMixin):
@@ -282,12 +420,10 @@ class Milestone(Workflow, ModelSQL, ModelView, MilestoneMixin):
             'readonly': Eval('state') != 'draft',
             },
         depends=['state'])
-    project_company = fields.Function(fields.Many2One('company.company',
-            'Project Company'),
-        'on_change_with_project_company', searcher='search_project_field')
-    project_party = fields.Function(fields.Many2One('party.party',
-            'Project Party'),
-        'on_change_with_project_party', searcher='search_project_field')
+    project_company = fields.Many2One('company.company', 'Project Company',
+        readonly=True)
+    project_party = fields.Many2One('party.party', 'Project Party',
+        readonly=True)
 
     is_credit = fields.Boolean('Is Credit?', readonly=True)
     invoice_date = fields.Date('Invoice Date', states={
@@ -298,23 +434,30 @@ class Milestone(Workflow, ModelSQL, ModelView, MilestoneMixin):
         states={
             'readonly': Eval('state') != 'draft',
             },
-        depends=['state'])
-    invoice = fields.One2One('account.invoice-project.invoice_milestone',
-        'milestone', 'invoice', 'Invoice', domain=[
+        depends=['state'],
+        help='Computed from the invoice date calculator when the milestone '
+        'is confirmed without it or the calculator is changed.')
+    milestone_type = fields.Many2One('project.invoice_milestone.type',
+        'Milestone Type', readonly=True, select=True, ondelete='SET NULL',
+        help='The milestone type the milestone was created from.')
+    invoice = fields.Many2One('account.invoice', 'Invoice', select=True,
+        ondelete='SET NULL', domain=[
             ('company', '=', Eval('project_company', -1)),
             ('party', '=', Eval('project_party', -1)),
             ], readonly=True, depends=['project_company', 'project_party'])
     # Selection items set in __setup__
     invoice_state = fields.Function(fields.Selection([], 'Invoice State'),
-        'get_invoice_state', searcher='search_invoice_state')
+        'get_invoice_fields', searcher='search_invoice_state')
     invoiced_amount = fields.Function(fields.Numeric('Invoiced Amount'),
-        'get_invoiced_amount')
+        'get_invoice_fields')
     state = fields.Selection([
             ('draft', 'Draft'),
             ('confirmed', 'Confirmed'),
             ('invoiced', 'Invoiced'),
             ('cancel', 'Cancelled'),
             ], 'State', readonly=True, select=True)
+    jobs = fields.One2Many('project.invoice_milestone.job', 'milestone',
+        'Background Jobs', readonly=True)
 
     @classmethod
     def __setup__(cls):
@@ -384,6 +527,56 @@ class Milestone(Workflow, ModelSQL, ModelView, MilestoneMixin):
                     'is a credit milestone.'),
                 })
 
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Work = pool.get('project.work')
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        work = Work.__table__()
+        relation_table = 'account_invoice-project_invoice_milestone'
+
+        table_h = TableHandler(cls, module_name)
+        fill_project_fields = not table_h.column_exist('project_company')
+        migrate_invoice = (not table_h.column_exist('invoice')
+            and TableHandler.table_exist(relation_table))
+
+        super(Milestone, cls).__register__(module_name)
+
+        table_h = TableHandler(cls, module_name)
+        # Migration from 4.6: invoice stored on the milestone
+        if migrate_invoice:
+            relation = Table(relation_table)
+            cursor.execute(*table.update([table.invoice],
+                    [relation.select(relation.invoice,
+                            where=relation.milestone == table.id)]))
+            TableHandler.drop_table(
+                'account.invoice-project.invoice_milestone', relation_table)
+        if fill_project_fields:
+            cursor.execute(*table.update(
+                    [table.project_company, table.project_party],
+                    [work.select(work.company,
+                            where=work.id == table.project),
+                        work.select(work.party,
+                            where=work.id == table.project)]))
+        table_h.index_action(['project_company', 'state'], 'add')
+        table_h.index_action(['project_party', 'state'], 'add')
+        table_h.index_action(
+            ['project_company', 'state', 'planned_invoice_date'], 'add')
+        table_h.index_action(['project', 'state'], 'add')
+        if backend.name() in ('postgresql', 'sqlite'):
+            # Partial indexes of the milestones pending to trigger
+            pending = ("state = 'confirmed' AND kind = 'system' "
+                "AND invoice IS NULL")
+            for name, columns in [
+                    ('pending_trigger_company', 'project_company, id'),
+                    ('pending_trigger_date', 'invoice_date'),
+                    ]:
+                cursor.execute('CREATE INDEX IF NOT EXISTS "%s_%s_index" '
+                    'ON "%s" (%s) WHERE %s' % (cls._table, name, cls._table,
+                        columns, pending))
+
     @classmethod
     def view_attributes(cls):
         return [
@@ -400,13 +593,6 @@ class Milestone(Workflow, ModelSQL, ModelView, MilestoneMixin):
         return (self.project.party.id
             if self.project and self.project.party else None)
 
-    @classmethod
-    def search_project_field(cls, name, clause):
-        project_fname = name.replace('project_', '')
-        return [
-            ('project.%s' % project_fname,) + tuple(clause[1:]),
-            ]
-
     @fields.depends('project', 'invoice_method')
     def on_change_with_currency(self):
         if self.invoice_method == 'fixed' and self.project:
@@ -416,11 +602,92 @@ class Milestone(Workflow, ModelSQL, ModelView, MilestoneMixin):
     def search_invoice_state(cls, name, clause):
         return [('invoice.state',) + tuple(clause[1:])]
 
-    def get_invoice_state(self, name):
-        return self.invoice.state if self.invoice else None
+    @classmethod
+    def get_invoice_fields(cls, milestones, names):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        table = cls.__table__()
+        invoice = Invoice.__table__()
+        cursor = Transaction().connection.cursor()
 
-    def get_invoiced_amount(self, name):
-        return self.invoice.untaxed_amount if self.invoice else Decimal(0)
+        result = {
+            'invoice_state': dict((m.id, None) for m in milestones),
+            'invoiced_amount': dict((m.id, _ZERO) for m in milestones),
+            }
+        rows = []
+        for sub_ids in grouped_slice([m.id for m in milestones]):
+            cursor.execute(*table.join(invoice,
+                    condition=invoice.id == table.invoice
+                    ).select(table.id, table.is_credit,
+                    table.advancement_amount, invoice.id, invoice.state,
+                    where=reduce_ids(table.id, sub_ids)))
+            rows.extend(cursor.fetchall())
+
+        if 'invoiced_amount' in names:
+            milestones_count, lines = cls._get_invoice_line_amounts(
+                list(set(r[3] for r in rows)))
+        for milestone_id, is_credit, advancement_amount, invoice_id, state \
+                in rows:
+            result['invoice_state'][milestone_id] = state
+            if 'invoiced_amount' not in names:
+                continue
+            invoice_lines = lines.get(invoice_id, [])
+            if milestones_count.get(invoice_id, 0) <= 1:
+                amount = sum((a for _, _, a in invoice_lines), _ZERO)
+            elif is_credit:
+                # Consolidated invoice
+                amount = advancement_amount
+            else:
+                origin = '%s,%s' % (cls.__name__, milestone_id)
+                amount = sum((a for o, _, a in invoice_lines if o == origin),
+                    _ZERO)
+            result['invoiced_amount'][milestone_id] = amount
+
+        for key in result.keys():
+            if key not in names:
+                del result[key]
+        return result
+
+    @classmethod
+    def _get_invoice_line_amounts(cls, invoice_ids):
+        """Return the number of milestones of each invoice id and the list of
+        (origin, product, amount) of the lines of each invoice id."""
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+        Currency = pool.get('currency.currency')
+        table = cls.__table__()
+        invoice = Invoice.__table__()
+        line = InvoiceLine.__table__()
+        currency = Currency.__table__()
+        cursor = Transaction().connection.cursor()
+
+        milestones_count = {}
+        lines = {}
+        for sub_ids in grouped_slice(invoice_ids):
+            cursor.execute(*table.select(table.invoice, Count(table.id),
+                    where=reduce_ids(table.invoice, sub_ids),
+                    group_by=table.invoice))
+            milestones_count.update(cursor.fetchall())
+
+            cursor.execute(*line.join(invoice,
+                    condition=invoice.id == line.invoice
+                    ).join(currency,
+                    condition=currency.id == invoice.currency
+                    ).select(line.invoice, line.origin, line.product,
+                    line.quantity, line.unit_price, currency.rounding,
+                    where=(reduce_ids(line.invoice, sub_ids)
+                        & (line.type == 'line'))))
+            for invoice_id, origin, product, quantity, unit_price, rounding \
+                    in cursor.fetchall():
+                rounding = Decimal(str(rounding))
+                amount = Decimal(str(quantity or 0)) * Decimal(
+                    str(unit_price or 0))
+                amount = (amount / rounding).quantize(Decimal('1.'),
+                    rounding=ROUND_HALF_EVEN) * rounding
+                lines.setdefault(invoice_id, []).append(
+                    (origin, product, amount))
+        return milestones_count, lines
 
     @staticmethod
     def default_state():
@@ -435,21 +702,49 @@ class Milestone(Workflow, ModelSQL, ModelView, MilestoneMixin):
         Sequence = pool.get('ir.sequence')
         Config = pool.get('project.invoice_milestone.configuration')
 
-        config = Config(1)
+        config = Config.get_cached()
         if not config.milestone_sequence:
             cls.raise_user_error('missing_project_invoice_milestone_sequence')
 
-        for milestone in milestones:
-            if milestone.number:
-                continue
-            milestone.number = Sequence.get_id(config.milestone_sequence.id)
+        to_number = [m for m in milestones if not m.number]
+        numbers = Sequence.reserve_numbers(config.milestone_sequence,
+            len(to_number))
+        for milestone, number in zip(to_number, numbers):
+            milestone.number = number
 
-    def _credit(self, credit_invoice):
+    @classmethod
+    def create_credits(cls, credits):
+        """Create the credit milestones of the (milestone, credit invoice)
+        pairs, already invoiced by the credit invoice."""
+        if not credits:
+            return []
+        origin_amounts = cls._get_origin_line_amounts(
+            list(set(m.invoice for m, _ in credits
+                    if m.invoice_method != 'fixed')))
+        milestones = [m._credit(credit_invoice, origin_amounts)
+            for m, credit_invoice in credits]
+        cls.save(milestones)
+        cls.confirm(milestones)
+        cls.invoiced(milestones)
+        return milestones
+
+    @classmethod
+    def _get_origin_line_amounts(cls, invoices):
+        "Return the amount of the invoice line of each milestone id origin"
+        amounts = {}
+        for invoice in invoices:
+            for line in invoice.lines:
+                origin = line.origin
+                if origin and origin.__name__ == cls.__name__:
+                    amounts.setdefault(origin.id, line.amount)
+        return amounts
+
+    def _credit(self, credit_invoice, origin_amounts=None):
         pool = Pool()
         Config = pool.get('project.invoice_milestone.configuration')
         Date = pool.get('ir.date')
 
-        config = Config(1)
+        config = Config.get_cached()
         milestone = self.__class__()
 
         for fname in ('project', 'advancement_product', 'compensation_product',
@@ -464,12 +759,10 @@ class Milestone(Workflow, ModelSQL, ModelView, MilestoneMixin):
             milestone.advancement_amount = -self.advancement_amount
         else:
             milestone.currency = self.invoice.currency
-            compensation_amount = Decimal(0)
-            for inv_line in self.invoice.lines:
-                if inv_line.origin == self:
-                    compensation_amount = -inv_line.amount
-                    break
-            milestone.advancement_amount = compensation_amount
+            if origin_amounts is None:
+                origin_amounts = self._get_origin_line_amounts([self.invoice])
+            milestone.advancement_amount = -origin_amounts.get(self.id,
+                Decimal(0))
         milestone.advancement_product = config.advancement_product
 
         milestone.project = self.project
@@ -480,14 +773,159 @@ class Milestone(Workflow, ModelSQL, ModelView, MilestoneMixin):
     @classmethod
     def cron_check_triggers(cls):
         'Cron Check Triggers'
-        milestones = cls.search([
+        pool = Pool()
+        Queue = pool.get('project.invoice_milestone.trigger.queue')
+        Config = pool.get('project.invoice_milestone.configuration')
+        Checkpoint = pool.get('project.invoice_milestone.cron.checkpoint')
+        Company = pool.get('company.company')
+
+        transaction = Transaction()
+        start = time.time()
+        config = Config.get_cached()
+
+        checkpoints = Checkpoint.search([])
+        if not checkpoints:
+            # Start a new cycle over the queue entries registered until now
+            last_queue = Queue.search([], order=[('id', 'DESC')], limit=1)
+            last_queue = last_queue[0].id if last_queue else 0
+            checkpoints = Checkpoint.create([{
+                        'company': c.id,
+                        'last_milestone': 0,
+                        'last_queue': last_queue,
+                        } for c in Company.search([])])
+        queue = Queue.search([
+                ('id', '<=', checkpoints[0].last_queue if checkpoints else 0),
+                ])
+        domain = cls._get_pending_trigger_domain(
+            list(set(q.project.id for q in queue)))
+
+        # The worker processes are shared by all the chunks of the run
+        workers = None
+        if config.trigger_processes and config.trigger_processes > 1:
+            workers = ProcessPool(config.trigger_processes,
+                initializer=_init_trigger_worker)
+        failed = []
+        finished = True
+        try:
+            for checkpoint in checkpoints:
+                while True:
+                    if (config.trigger_time_budget
+                            and time.time() - start
+                            >= config.trigger_time_budget):
+                        finished = False
+                        break
+                    milestones = cls.search(domain + [
+                            ('project_company', '=', checkpoint.company.id),
+                            ('id', '>', checkpoint.last_milestone),
+                            ], order=[('id', 'ASC')],
+                        limit=config.trigger_chunk_size)
+                    if not milestones:
+                        break
+                    failed += cls._check_trigger_chunk(milestones,
+                        workers=workers)
+                    checkpoint.last_milestone = milestones[-1].id
+                    checkpoint.save()
+                    transaction.commit()
+                if not finished:
+                    logger.info('Milestone triggers check stopped by time '
+                        'budget at milestone %s of company %s',
+                        checkpoint.last_milestone, checkpoint.company.id)
+                    break
+        finally:
+            if workers:
+                workers.close()
+                workers.join()
+
+        if finished:
+            Queue.delete(queue)
+            Checkpoint.delete(checkpoints)
+        if failed:
+            # Retry the failed projects on the next cycle
+            Queue.create([{'project': p.id}
+                    for p in set(m.project for m in failed)])
+
+    @classmethod
+    def _check_trigger_chunk(cls, milestones, workers=None):
+        "Check the triggers of a chunk of the cron and return failed ones"
+        pool = Pool()
+        Config = pool.get('project.invoice_milestone.configuration')
+
+        config = Config.get_cached()
+        with Transaction().set_context(milestone_sync=True):
+            if not config.trigger_processes:
+                cls.check_trigger(milestones)
+                return []
+            errors = cls.check_trigger_sharded(milestones,
+                processes=config.trigger_processes, workers=workers)
+        return cls.browse(sum((ids for ids, _ in errors), []))
+
+    @classmethod
+    def check_trigger_sharded(cls, milestones, processes=1, workers=None):
+        """Check the triggers and invoice the milestones split in shards.
+
+        Each shard is processed in its own transaction, so an error only
+        rolls back the milestones of its shard. With more than one process,
+        the shards are dispatched to a pool of forked workers, each one with
+        its own database connection. The workers pool is created for the
+        call unless an existing one is given.
+        Return the list of (milestone ids, error) of the failed shards."""
+        transaction = Transaction()
+        # Ensure the workers see the data of the coordinator
+        transaction.commit()
+        context = dict(transaction.context)
+        args = [(transaction.database.name, transaction.user, context, ids)
+            for ids in cls._get_trigger_shards(milestones)]
+
+        if workers and len(args) > 1:
+            results = workers.map(_check_trigger_shard, args)
+        elif processes > 1 and len(args) > 1:
+            workers = ProcessPool(min(processes, len(args)),
+                initializer=_init_trigger_worker)
+            try:
+                results = workers.map(_check_trigger_shard, args)
+            finally:
+                workers.close()
+                workers.join()
+        else:
+            results = map(_check_trigger_shard, args)
+
+        errors = [(ids, error) for ids, error in results if error]
+        if errors:
+            logger.warning('%s of %s milestone shards failed', len(errors),
+                len(args))
+        return errors
+
+    @classmethod
+    def _get_trigger_shards(cls, milestones):
+        "Return the milestone ids split by company and project"
+        shards = {}
+        for milestone in milestones:
+            key = (milestone.project_company.id, milestone.project.id)
+            shards.setdefault(key, []).append(milestone.id)
+        return [shards[k] for k in sorted(shards)]
+
+    @classmethod
+    def _get_pending_trigger_domain(cls, project_ids):
+        """Return the domain of milestones to check by the cron.
+
+        Only the milestones already triggered whose invoice date is due and
+        the milestones of the projects enqueued since the last run are
+        evaluated."""
+        pool = Pool()
+        Date = pool.get('ir.date')
+
+        pending = [('invoice_date', '<=', Date.today())]
+        if project_ids:
+            pending = ['OR',
+                pending,
+                ('project', 'in', project_ids),
+                ]
+        return [
             ('state', '=', 'confirmed'),
             ('kind', '=', 'system'),
             ('invoice', '=', None),
-            ('invoice_date', '!=', None),
-            ])
-        if milestones:
-            cls.check_trigger(milestones)
+            pending,
+            ]
 
     @classmethod
     @ModelView.button
@@ -509,6 +947,10 @@ class Milestone(Workflow, ModelSQL, ModelView, MilestoneMixin):
     @Workflow.transition('confirmed')
     def confirm(cls, milestones):
         cls.set_number(milestones)
+        for milestone in milestones:
+            if not milestone.planned_invoice_date:
+                milestone.planned_invoice_date = (
+                    milestone._calc_invoice_date())
         cls.save(milestones)
 
     @classmethod
@@ -527,24 +969,95 @@ class Milestone(Workflow, ModelSQL, ModelView, MilestoneMixin):
     @classmethod
     @ModelView.button
     def check_trigger(cls, milestones):
+        if cls._enqueue_jobs('check_trigger', milestones):
+            return
         triggered_milestones = cls.check_trigger_condition(milestones)
-        with Transaction().set_user(0):
+        with Transaction().set_user(0), \
+                Transaction().set_context(milestone_sync=True):
             cls.do_invoice(triggered_milestones)
 
+    @classmethod
+    def _enqueue_jobs(cls, method, milestones):
+        """Enqueue the method for milestones if invoicing runs in background.
+        Return True if the jobs have been enqueued."""
+        pool = Pool()
+        Config = pool.get('project.invoice_milestone.configuration')
+        Job = pool.get('project.invoice_milestone.job')
+
+        if Transaction().context.get('milestone_sync'):
+            return False
+        config = Config.get_cached()
+        if not config.invoice_in_background:
+            return False
+        Job.enqueue(method, milestones)
+        return True
+
     @classmethod
     def check_trigger_condition(cls, milestones):
-        triggered_milestones = []
-        for milestone in milestones:
-            if (milestone.state != 'confirmed' or milestone.kind == 'manual' or
-                    milestone.invoice):
+        """Return the milestones whose trigger condition is fulfilled.
+
+        Candidates are grouped by trigger and evaluated with the
+        check_trigger_<trigger>_batch() classmethod when it exists. Triggers
+        without batch evaluator fall back to the per-record
+        check_trigger_<trigger>() method."""
+        candidates = [m for m in milestones
+            if (m.state == 'confirmed' and m.kind != 'manual'
+                and not m.invoice)]
+
+        by_trigger = {}
+        for milestone in candidates:
+            by_trigger.setdefault(milestone.trigger, []).append(milestone)
+
+        triggered = set()
+        for trigger, trigger_milestones in by_trigger.iteritems():
+            batch_method = getattr(cls, 'check_trigger_%s_batch' % trigger,
+                None)
+            if batch_method:
+                triggered.update(batch_method(trigger_milestones))
                 continue
-            method = getattr(milestone, 'check_trigger_%s'
-                    % milestone.trigger)
-            triggered = method()
-            if not triggered:
-                continue
-            triggered_milestones.append(milestone)
-        return triggered_milestones
+            for milestone in trigger_milestones:
+                method = getattr(milestone, 'check_trigger_%s' % trigger)
+                if method():
+                    triggered.add(milestone)
+        # Keep the order of the received milestones
+        return [m for m in candidates if m in triggered]
+
+    @staticmethod
+    def _group_by_project(milestones):
+        projects = {}
+        for milestone in milestones:
+            projects.setdefault(milestone.project, []).append(milestone)
+        return projects
+
+    @classmethod
+    def check_trigger_start_project_batch(cls, milestones):
+        triggered = []
+        for project, project_milestones in cls._group_by_project(
+                milestones).iteritems():
+            if project.state == 'opened':
+                triggered.extend(project_milestones)
+        return triggered
+
+    @classmethod
+    def check_trigger_finish_project_batch(cls, milestones):
+        triggered = []
+        for project, project_milestones in cls._group_by_project(
+                milestones).iteritems():
+            if project.state == 'done':
+                triggered.extend(project_milestones)
+        return triggered
+
+    @classmethod
+    def check_trigger_progress_batch(cls, milestones):
+        # percent_progress_amount rolls up the whole project tree, so it is
+        # computed only once per project
+        triggered = []
+        for project, project_milestones in cls._group_by_project(
+                milestones).iteritems():
+            progress = project.percent_progress_amount
+            triggered.extend(m for m in project_milestones
+                if progress >= m.trigger_progress)
+        return triggered
 
     def check_trigger_start_project(self):
         if self.project.state == 'opened':
@@ -566,79 +1079,292 @@ class Milestone(Workflow, ModelSQL, ModelView, MilestoneMixin):
     def do_invoice(cls, milestones):
         """
         It's a replica of project.work.invoice()
+
+        The invoices are computed in memory and stored in batches. A batch is
+        stored before computing a milestone of a project already in it
+        because its amounts depend on the previous invoices of the project.
+        If invoices are consolidated in the configuration, the milestones
+        with the same consolidation key share the same invoice.
+        The projects of the milestones are locked first, so concurrent runs
+        never invoice the same milestone.
         """
         pool = Pool()
         Date = pool.get('ir.date')
         Invoice = pool.get('account.invoice')
+        Config = pool.get('project.invoice_milestone.configuration')
 
+        if cls._enqueue_jobs('do_invoice', milestones):
+            return
+        milestones, invoiced = cls._lock_projects(milestones)
         today = Date.today()
+        to_date = [m for m in milestones if not m.invoice_date]
+        for milestone in to_date:
+            milestone.invoice_date = milestone._calc_invoice_date()
+        if to_date:
+            cls.save(to_date)
+
+        config = Config.get_cached()
+        to_compute = [m for m in milestones
+            if m.id not in invoiced
+            and (m.kind != 'system' or m.invoice_date <= today)]
+        descriptions = cls.render_invoice_line_descriptions(to_compute)
         invoices = []
         to_invoice = []
+        to_save = []
+        projects = set()
+        consolidated = {}
         for milestone in milestones:
-            if not milestone.invoice_date:
-                milestone.invoice_date = milestone._calc_invoice_date()
-                milestone.save()
             if(milestone.kind == 'system' and milestone.invoice_date > today):
                 continue
-            if milestone.invoice:
+            if milestone.id in invoiced:
                 to_invoice.append(milestone)
                 continue
+            milestone._invoice_line_description = descriptions[milestone.id]
 
-            inv_line_vals = milestone._get_line_vals_to_invoice()
-            if not inv_line_vals and milestone.invoice_method != 'remainder':
-                continue
+            if milestone.project in projects:
+                invoices += cls._save_invoices(to_save)
+                to_save = []
+                projects = set()
 
-            invoice = milestone._get_invoice()
-            invoice.project_milestone = milestone
-            invoice.lines = []
-            if inv_line_vals:
-                invoice.save()
-            elif milestone.invoice_method not in ('percent', 'progress',
-                    'remainder'):
+            invoice_values = milestone._compute_invoice()
+            if not invoice_values:
                 continue
-
-            invoice_amount = Decimal(0)
-            for key, grouped_inv_line_vals in groupby(inv_line_vals,
-                    key=milestone.project._group_lines_to_invoice_key):
-                grouped_inv_line_vals = list(grouped_inv_line_vals)
-                key = dict(key)
-                invoice_line = milestone.project._get_invoice_line(
-                    key, invoice, grouped_inv_line_vals)
-                invoice_line.invoice = invoice
-                invoice_line.origin = milestone
-                invoice_line.save()
-                invoice_amount += invoice_line.amount
-
-                origins = {}
-                for line_vals in grouped_inv_line_vals:
-                    origin = line_vals.get('origin', None)
-
-                    if origin:
-                        origin.invoice_line = invoice_line
-                        origins.setdefault(origin.__class__, []).append(origin)
-                for klass, records in origins.iteritems():
-                    klass.save(records)  # Store first new origins
-
-            if milestone.invoice_method in ('percent', 'progress', 'remainder'):
-                invoice_line = milestone._get_compensation_invoice_line(
-                    invoice_amount)
-                if invoice_line:
-                    if not inv_line_vals:
-                        invoice.save()
-                    invoice_line.invoice = invoice
-                    invoice_line.save()
-                elif not inv_line_vals:
-                    # not progress/remainder lines nor compensation
-                    continue
-
-            invoices.append(invoice)
+            invoice, lines, origins = invoice_values
+            if config.consolidate_invoices:
+                key = milestone._get_invoice_consolidation_key(invoice)
+                invoice = consolidated.setdefault(key, invoice)
+            to_save.append((milestone, invoice, lines, origins))
+            projects.add(milestone.project)
             to_invoice.append(milestone)
+        invoices += cls._save_invoices(to_save)
+        invoices = list(set(invoices))
 
         if invoices:
             Invoice.update_taxes(Invoice.browse([i.id for i in invoices]))
         if to_invoice:
             cls.invoiced(to_invoice)
 
+    @classmethod
+    def _lock_projects(cls, milestones):
+        """Lock the projects of milestones and the milestones themselves and
+        return the milestones of the locked projects which are still
+        confirmed, and the ids of those already with an invoice, both read
+        again from the database.
+
+        On PostgreSQL the projects locked by another transaction are skipped,
+        so concurrent runs invoice different projects, and their milestones
+        are enqueued as background jobs to be invoiced later. Locking the
+        rows of the milestones makes the transaction fail if a concurrent
+        one changed them after it started. Other backends serialize the
+        transactions which write."""
+        pool = Pool()
+        Work = pool.get('project.work')
+        Job = pool.get('project.invoice_milestone.job')
+        table = cls.__table__()
+        work = Work.__table__()
+        cursor = Transaction().connection.cursor()
+        for_update = backend.name() == 'postgresql'
+
+        project_ids = set(m.project.id for m in milestones)
+        if for_update:
+            locked = set()
+            for sub_ids in grouped_slice(list(project_ids)):
+                query, params = tuple(work.select(work.id,
+                        where=reduce_ids(work.id, sub_ids)))
+                cursor.execute(query + ' FOR UPDATE SKIP LOCKED', params)
+                locked.update(i for i, in cursor.fetchall())
+            skipped = [m for m in milestones if m.project.id not in locked]
+            if skipped:
+                logger.info('Enqueue milestones of projects locked by another '
+                    'transaction: %s', [m.id for m in skipped])
+                Job.enqueue('do_invoice', skipped)
+            milestones = [m for m in milestones if m.project.id in locked]
+
+        confirmed = set()
+        invoiced = set()
+        for sub_ids in grouped_slice([m.id for m in milestones]):
+            query, params = tuple(table.select(table.id, table.invoice,
+                    where=(reduce_ids(table.id, sub_ids)
+                        & (table.state == 'confirmed'))))
+            if for_update:
+                query += ' FOR UPDATE'
+            cursor.execute(query, params)
+            for milestone_id, invoice_id in cursor.fetchall():
+                confirmed.add(milestone_id)
+                if invoice_id is not None:
+                    invoiced.add(milestone_id)
+        return [m for m in milestones if m.id in confirmed], invoiced
+
+    def _compute_invoice(self):
+        """Return the invoice, its lines and the origins of each line to
+        invoice the milestone, without saving them."""
+        inv_line_vals = self._get_line_vals_to_invoice()
+        if not inv_line_vals and self.invoice_method != 'remainder':
+            return
+
+        invoice = self._get_invoice()
+        invoice.lines = []
+
+        lines = []
+        origins = []
+        invoice_amount = Decimal(0)
+        for key, grouped_inv_line_vals in groupby(inv_line_vals,
+                key=self.project._group_lines_to_invoice_key):
+            grouped_inv_line_vals = list(grouped_inv_line_vals)
+            key = dict(key)
+            invoice_line = self.project._get_invoice_line(
+                key, invoice, grouped_inv_line_vals)
+            invoice_line.invoice = invoice
+            invoice_line.origin = self
+            invoice_amount += invoice_line.on_change_with_amount()
+            lines.append(invoice_line)
+            origins.append([v['origin'] for v in grouped_inv_line_vals
+                    if v.get('origin')])
+
+        if self.invoice_method in ('percent', 'progress', 'remainder'):
+            invoice_line = self._get_compensation_invoice_line(invoice_amount)
+            if invoice_line:
+                invoice_line.invoice = invoice
+                lines.append(invoice_line)
+                origins.append([])
+            elif not inv_line_vals:
+                # not progress/remainder lines nor compensation
+                return
+        return invoice, lines, origins
+
+    def _get_invoice_consolidation_key(self, invoice):
+        "Return the key to group the milestone invoices in one invoice"
+        return (invoice.party, invoice.company, invoice.currency,
+            invoice.payment_term, invoice.invoice_date)
+
+    @classmethod
+    def _save_invoices(cls, to_save):
+        """Store the invoices computed by _compute_invoice() with one batch
+        per model and return them.
+        to_save is a list of (milestone, invoice, lines, origins)."""
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+        Work = pool.get('project.work')
+
+        if not to_save:
+            return []
+        invoices = []
+        for _, invoice, _, _ in to_save:
+            if invoice not in invoices:
+                invoices.append(invoice)
+        Invoice.save([i for i in invoices if i.id is None or i.id < 0])
+
+        lines = []
+        for _, invoice, invoice_lines, _ in to_save:
+            for invoice_line in invoice_lines:
+                invoice_line.invoice = invoice
+            lines.extend(invoice_lines)
+        InvoiceLine.save(lines)
+
+        by_invoice = {}
+        for milestone, invoice, _, _ in to_save:
+            by_invoice.setdefault(invoice.id, []).append(milestone)
+        cls.write(*sum(([ms, {'invoice': i}]
+                    for i, ms in by_invoice.iteritems()), []))
+
+        origins = {}
+        for _, _, invoice_lines, line_origins in to_save:
+            for invoice_line, records in zip(invoice_lines, line_origins):
+                for origin in records:
+                    origin.invoice_line = invoice_line
+                    origins.setdefault(origin.__class__, []).append(origin)
+        for klass, records in origins.iteritems():
+            klass.save(records)
+        Work.update_compensation_ledger(
+            list(set(m.project for m, _, _, _ in to_save)))
+        return invoices
+
+    @classmethod
+    def forecast(cls, projects, date):
+        """Return the projected invoicing of the confirmed milestones of
+        projects with invoice date until date as a list of MilestoneForecast.
+
+        It computes the same lines and compensation than do_invoice() but
+        nothing is stored. The milestones of each project are simulated in
+        order of invoice date, each one on top of the previous ones. The
+        milestones not triggered yet are expected to be invoiced on their
+        planned invoice date or, if it is not set, on their invoice date
+        computed from today."""
+        pool = Pool()
+        Work = pool.get('project.work')
+
+        forecasts = []
+        for sub_projects in grouped_slice(projects):
+            sub_projects = list(sub_projects)
+            pending = Work.get_pending_to_compensate_amounts(sub_projects)
+            milestones = cls.search([
+                    ('project', 'in', [p.id for p in sub_projects]),
+                    ('state', '=', 'confirmed'),
+                    ('invoice', '=', None),
+                    ['OR',
+                        ('invoice_date', '<=', date),
+                        [
+                            ('invoice_date', '=', None),
+                            ['OR',
+                                ('planned_invoice_date', '<=', date),
+                                ('planned_invoice_date', '=', None),
+                                ],
+                            ],
+                        ],
+                    ], order=[('project', 'ASC'), ('id', 'ASC')])
+            by_project = {}
+            for milestone in milestones:
+                invoice_date = (milestone.invoice_date
+                    or milestone.planned_invoice_date
+                    or milestone._calc_invoice_date())
+                if invoice_date > date:
+                    continue
+                by_project.setdefault(milestone.project.id, []).append(
+                    (invoice_date, milestone.id, milestone))
+            for project_id in sorted(by_project):
+                projected = {}
+                for invoice_date, _, milestone in sorted(
+                        by_project[project_id]):
+                    amount, compensation = milestone._forecast_amounts(
+                        projected, pending)
+                    if not amount and not compensation:
+                        continue
+                    forecasts.append(MilestoneForecast(milestone.id,
+                            project_id, invoice_date, amount, compensation))
+        return forecasts
+
+    def _forecast_amounts(self, projected, pending):
+        """Return the amount and the compensation the milestone would invoice.
+        projected is the quantity already forecast by work id and pending the
+        advanced amount pending to compensate by project id. Both are updated
+        with the forecast of the milestone."""
+        currency = self.project.company.currency
+        amount = _ZERO
+        for line_vals in self._get_line_vals_to_invoice():
+            quantity = line_vals['quantity']
+            origin = line_vals.get('origin')
+            if (self.invoice_method in ('progress', 'remainder')
+                    and origin and origin.work):
+                # The lines subtract only the progress already invoiced
+                work_id = origin.work.id
+                quantity -= projected.get(work_id, 0)
+                if quantity <= 0:
+                    continue
+                projected[work_id] = projected.get(work_id, 0) + quantity
+            amount += currency.round(Decimal(str(quantity))
+                * line_vals['unit_price'])
+        project_id = self.project.id
+        compensation = _ZERO
+        if self.invoice_method == 'fixed':
+            pending[project_id] = pending.get(project_id, _ZERO) + amount
+        elif self.invoice_method in ('percent', 'progress', 'remainder'):
+            compensated = currency.round(self._get_compensation_amount(
+                    amount, pending.get(project_id, _ZERO)))
+            pending[project_id] = pending.get(project_id, _ZERO) - compensated
+            compensation = -compensated
+        return amount, compensation
+
     def _calc_invoice_date(self):
         pool = Pool()
         Date = pool.get('ir.date')
@@ -653,9 +1379,12 @@ class Milestone(Workflow, ModelSQL, ModelView, MilestoneMixin):
         invoice.invoice_date = self.invoice_date
         return invoice
 
-    def _get_line_vals_to_invoice(self, work=None, test=False):
+    def _get_line_vals_to_invoice(self, work=None, test=False,
+            children=None):
         """Return line vals for work and children.
-        If work is not supplied, it use milestone's project"""
+        If work is not supplied, it use milestone's project.
+        children is the dictionary of children of each work id of the tree
+        returned by _get_work_children(); it is computed if not supplied."""
         if self.invoice_method == 'fixed':
             return self._get_line_vals_to_invoice_fixed()
 
@@ -667,16 +1396,35 @@ class Milestone(Workflow, ModelSQL, ModelView, MilestoneMixin):
             work = self.project
         if test is None:
             test = work._test_group_invoice()
+        if children is None:
+            children = self._get_work_children(work)
 
         lines += getattr(
             work, '_get_lines_to_invoice_%s' % self.invoice_method)()
-        for children in work.children:
-            if children.type == 'project':
-                if test != children._test_group_invoice():
+        for child in children.get(work.id, []):
+            if child.type == 'project':
+                if test != child._test_group_invoice():
                     continue
-            lines += self._get_line_vals_to_invoice(work=children, test=test)
+            lines += self._get_line_vals_to_invoice(work=child, test=test,
+                children=children)
         return lines
 
+    @staticmethod
+    def _get_work_children(work):
+        """Return the children of each work id of the tree of work.
+        The whole tree is searched with one query and its records are
+        instantiated together, so their fields are read in bulk."""
+        pool = Pool()
+        Work = pool.get('project.work')
+
+        children = {}
+        for child in Work.search([
+                    ('parent', 'child_of', [work.id]),
+                    ('id', '!=', work.id),
+                    ]):
+            children.setdefault(child.parent.id, []).append(child)
+        return children
+
     def _get_line_vals_to_invoice_fixed(self):
         if self.state != 'confirmed' or self.invoice:
             return []
@@ -713,21 +1461,7 @@ class Milestone(Workflow, ModelSQL, ModelView, MilestoneMixin):
     def _get_compensation_invoice_line(self, current_invoice_amount):
         InvoiceLine = Pool().get('account.invoice.line')
 
-        amount = self.project.pending_to_compensate_advanced_amount
-        # TODO: review
-        # if self.invoice_method == 'remainder':
-        #     if (self.group.merited_amount == self.group.total_amount
-        #             and (self.group.invoiced_amount - amount + current_invoice_amount)
-        #                 == self.group.merited_amount):
-        #         # It closes the milestone group
-        #         current_invoice_amount = None
-
-        if (current_invoice_amount is not None
-                and self.invoice_method != 'remainder'
-                and current_invoice_amount < amount):
-            # If it is remainder => if compensates all, generating a negative invoice if it corresponds
-            # Otherwise, it never generates a negative invoice
-            amount = current_invoice_amount
+        amount = self._get_compensation_amount(current_invoice_amount)
         if amount == _ZERO:
             return
 
@@ -745,6 +1479,30 @@ class Milestone(Workflow, ModelSQL, ModelView, MilestoneMixin):
         invoice_line.unit_price = amount
         return invoice_line
 
+    def _get_compensation_amount(self, current_invoice_amount,
+            pending_amount=None):
+        """Return the advanced amount to compensate in the milestone invoice.
+        pending_amount is the advanced amount pending to compensate of the
+        project, read from its ledger if not supplied."""
+        amount = pending_amount
+        if amount is None:
+            amount = self.project.pending_to_compensate_advanced_amount
+        # TODO: review
+        # if self.invoice_method == 'remainder':
+        #     if (self.group.merited_amount == self.group.total_amount
+        #             and (self.group.invoiced_amount - amount + current_invoice_amount)
+        #                 == self.group.merited_amount):
+        #         # It closes the milestone group
+        #         current_invoice_amount = None
+
+        if (current_invoice_amount is not None
+                and self.invoice_method != 'remainder'
+                and current_invoice_amount < amount):
+            # If it is remainder => if compensates all, generating a negative invoice if it corresponds
+            # Otherwise, it never generates a negative invoice
+            amount = current_invoice_amount
+        return amount
+
     @staticmethod
     def template_context(record):
         """Generate the tempalte context"""
@@ -753,11 +1511,135 @@ class Milestone(Workflow, ModelSQL, ModelView, MilestoneMixin):
             }
 
     def _calc_invoice_line_description(self):
-        if self.description:
-            template = Jinja2Template(self.description)
-            template_context = self.template_context(self)
-            return template.render(template_context)
-        return self.number
+        description = getattr(self, '_invoice_line_description', None)
+        if description is None:
+            description = self.render_invoice_line_descriptions(
+                [self])[self.id]
+        return description
+
+    @classmethod
+    def render_invoice_line_descriptions(cls, milestones):
+        """Return a dictionary with the invoice line description of each
+        milestone id.
+        The milestones with the same description text share its compiled
+        template."""
+        descriptions = {}
+        by_text = {}
+        for milestone in milestones:
+            if milestone.description:
+                by_text.setdefault(milestone.description, []).append(
+                    milestone)
+            else:
+                descriptions[milestone.id] = milestone.number
+        for text, sub_milestones in by_text.iteritems():
+            template = template_cache.get(text)
+            for milestone in sub_milestones:
+                descriptions[milestone.id] = template.render(
+                    cls.template_context(milestone))
+        return descriptions
+
+    @classmethod
+    def _set_project_fields(cls, vlist):
+        "Copy the company and party of the project into the values"
+        pool = Pool()
+        Work = pool.get('project.work')
+        project_ids = set(v['project'] for v in vlist if v.get('project'))
+        projects = dict((p.id, p) for p in Work.browse(list(project_ids)))
+        for values in vlist:
+            if values.get('project'):
+                project = projects[values['project']]
+                values['project_company'] = project.company.id
+                values['project_party'] = (project.party.id
+                    if project.party else None)
+
+    @classmethod
+    def sync_project_fields(cls, projects):
+        "Update the company and party of the milestones of projects"
+        to_write = {}
+        with Transaction().set_user(0):
+            for sub_projects in grouped_slice(projects):
+                for milestone in cls.search([
+                            ('project', 'in', [p.id for p in sub_projects]),
+                            ]):
+                    project = milestone.project
+                    values = (project.company, project.party)
+                    if values != (milestone.project_company,
+                            milestone.project_party):
+                        to_write.setdefault(values, []).append(milestone)
+            args = []
+            for (company, party), milestones in to_write.iteritems():
+                args.extend((milestones, {
+                            'project_company': company.id,
+                            'project_party': party.id if party else None,
+                            }))
+            if args:
+                cls.write(*args)
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Work = pool.get('project.work')
+        vlist = [v.copy() for v in vlist]
+        cls._set_project_fields(vlist)
+        milestones = super(Milestone, cls).create(vlist)
+        Work.update_milestone_progress_threshold(
+            [m.project for m in milestones])
+        return milestones
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Work = pool.get('project.work')
+
+        threshold_fields = {'state', 'kind', 'trigger', 'trigger_progress',
+            'project', 'invoice'}
+        projects = set()
+        to_plan = []
+        args = list(args)
+        for i in range(1, len(args), 2):
+            milestones, values = args[i - 1], args[i]
+            if values.get('project'):
+                values = values.copy()
+                cls._set_project_fields([values])
+                args[i] = values
+            if threshold_fields & set(values):
+                projects.update(m.project for m in milestones)
+            if (_DELTA_FIELDS & set(values)
+                    and 'planned_invoice_date' not in values):
+                to_plan.extend(milestones)
+        super(Milestone, cls).write(*args)
+        if projects:
+            # Include the new projects of the milestones
+            projects.update(m.project for m in sum(args[::2], []))
+            Work.update_milestone_progress_threshold(list(projects))
+        if to_plan:
+            cls._update_planned_invoice_date(to_plan)
+
+    @classmethod
+    def _update_planned_invoice_date(cls, milestones):
+        "Compute again the planned invoice date of not invoiced milestones"
+        by_date = {}
+        for milestone in cls.browse([m.id for m in milestones]):
+            if milestone.state not in ('draft', 'confirmed'):
+                continue
+            planned_invoice_date = milestone._calc_invoice_date()
+            if planned_invoice_date != milestone.planned_invoice_date:
+                by_date.setdefault(planned_invoice_date, []).append(milestone)
+        to_write = []
+        for planned_invoice_date, sub_milestones in by_date.iteritems():
+            to_write.extend((sub_milestones, {
+                        'planned_invoice_date': planned_invoice_date,
+                        }))
+        if to_write:
+            cls.write(*to_write)
+
+    @classmethod
+    def delete(cls, milestones):
+        pool = Pool()
+        Work = pool.get('project.work')
+        projects = list(set(m.project for m in milestones))
+        super(Milestone, cls).delete(milestones)
+        Work.update_milestone_progress_threshold(projects)
 
     @classmethod
     def copy(cls, milestones, default=None):
@@ -766,4 +1648,214 @@ class Milestone(Workflow, ModelSQL, ModelView, MilestoneMixin):
         default.setdefault('number', None)
         default.setdefault('invoice_date', None)
         default.setdefault('invoice', None)
+        default.setdefault('planned_invoice_date', None)
+        default.setdefault('jobs', None)
         return super(Milestone, cls).copy(milestones, default)
+
+
+class MilestoneTriggerQueue(ModelSQL):
+    'Milestone Trigger Queue'
+    __name__ = 'project.invoice_milestone.trigger.queue'
+    project = fields.Many2One('project.work', 'Project', required=True,
+        select=True, ondelete='CASCADE')
+
+    @classmethod
+    def enqueue(cls, projects):
+        """Register the projects whose milestone triggers must be checked by
+        the next run of the cron."""
+        project_ids = set(p.id for p in projects
+            if p.type == 'project' and p.project_invoice_method == 'milestone')
+        if not project_ids:
+            return
+        with Transaction().set_user(0):
+            queued = cls.search([
+                    ('project', 'in', list(project_ids)),
+                    ])
+            project_ids -= set(q.project.id for q in queued)
+            if project_ids:
+                cls.create([{'project': p} for p in project_ids])
+
+
+class MilestoneCronCheckpoint(ModelSQL):
+    'Milestone Cron Checkpoint'
+    __name__ = 'project.invoice_milestone.cron.checkpoint'
+    company = fields.Many2One('company.company', 'Company', required=True,
+        select=True, ondelete='CASCADE')
+    last_milestone = fields.Integer('Last Milestone', required=True,
+        help='The last milestone processed by the current cron cycle.')
+    last_queue = fields.Integer('Last Queue Entry', required=True,
+        help='The last trigger queue entry included in the current cron '
+        'cycle.')
+
+
+class MilestoneJob(ModelSQL, ModelView):
+    'Milestone Background Job'
+    __name__ = 'project.invoice_milestone.job'
+    milestone = fields.Many2One('project.invoice_milestone', 'Milestone',
+        required=True, readonly=True, select=True, ondelete='CASCADE')
+    method = fields.Selection([
+            ('check_trigger', 'Check Triggers'),
+            ('do_invoice', 'Invoice'),
+            ], 'Method', required=True, readonly=True)
+    state = fields.Selection([
+            ('pending', 'Pending'),
+            ('done', 'Done'),
+            ('error', 'Error'),
+            ], 'State', required=True, readonly=True, select=True)
+    error = fields.Text('Error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(MilestoneJob, cls).__setup__()
+        cls._order.insert(0, ('id', 'DESC'))
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @classmethod
+    def enqueue(cls, method, milestones):
+        "Create the pending jobs to run method on milestones"
+        milestone_ids = set(m.id for m in milestones)
+        with Transaction().set_user(0):
+            pending = cls.search([
+                    ('milestone', 'in', list(milestone_ids)),
+                    ('method', '=', method),
+                    ('state', '=', 'pending'),
+                    ])
+            milestone_ids -= set(j.milestone.id for j in pending)
+            cls.create([{
+                        'milestone': m,
+                        'method': method,
+                        } for m in sorted(milestone_ids)])
+
+    @classmethod
+    def cron_run(cls):
+        "Run the pending jobs in batches, one transaction per batch"
+        transaction = Transaction()
+
+        jobs = cls.search([
+                ('state', '=', 'pending'),
+                ], order=[('id', 'ASC')])
+        by_method = {}
+        for job in jobs:
+            by_method.setdefault(job.method, []).append(job.id)
+        for method, job_ids in by_method.iteritems():
+            for sub_ids in grouped_slice(job_ids):
+                sub_ids = list(sub_ids)
+                try:
+                    cls._run(method, sub_ids)
+                    transaction.commit()
+                except Exception:
+                    transaction.rollback()
+                    # Find the failing milestones
+                    for job_id in sub_ids:
+                        try:
+                            cls._run(method, [job_id])
+                        except Exception:
+                            transaction.rollback()
+                            logger.error('Error running milestone job %s',
+                                job_id, exc_info=True)
+                            cls.write([cls(job_id)], {
+                                    'state': 'error',
+                                    'error': traceback.format_exc(),
+                                    })
+                        transaction.commit()
+
+    @classmethod
+    def _run(cls, method, job_ids):
+        pool = Pool()
+        Milestone = pool.get('project.invoice_milestone')
+
+        jobs = cls.browse(job_ids)
+        # Set as done before running so the method can enqueue them again
+        cls.write(jobs, {
+                'state': 'done',
+                'error': None,
+                })
+        # Run as root like check_trigger, whoever requested the job
+        with Transaction().set_user(0), \
+                Transaction().set_context(milestone_sync=True):
+            getattr(Milestone, method)([j.milestone for j in jobs])
+
+
+class ForecastStart(ModelView):
+    'Milestone Invoicing Forecast Start'
+    __name__ = 'project.invoice_milestone.forecast.start'
+    date = fields.Date('Until Date', required=True)
+
+    @staticmethod
+    def default_date():
+        Date = Pool().get('ir.date')
+        return Date.today() + relativedelta(days=90)
+
+
+class ForecastResult(ModelView):
+    'Milestone Invoicing Forecast Result'
+    __name__ = 'project.invoice_milestone.forecast.result'
+    lines = fields.One2Many('project.invoice_milestone.forecast.line', None,
+        'Lines', readonly=True)
+    total_amount = fields.Numeric('Total Amount', readonly=True,
+        digits=(16, 2))
+
+
+class ForecastLine(ModelView):
+    'Milestone Invoicing Forecast Line'
+    __name__ = 'project.invoice_milestone.forecast.line'
+    milestone = fields.Many2One('project.invoice_milestone', 'Milestone',
+        readonly=True)
+    project = fields.Many2One('project.work', 'Project', readonly=True)
+    party = fields.Many2One('party.party', 'Party', readonly=True)
+    invoice_date = fields.Date('Invoice Date', readonly=True)
+    amount = fields.Numeric('Amount', digits=(16, 2), readonly=True)
+    compensation = fields.Numeric('Compensation', digits=(16, 2),
+        readonly=True)
+    total_amount = fields.Numeric('Total Amount', digits=(16, 2),
+        readonly=True)
+
+
+class Forecast(Wizard):
+    'Milestone Invoicing Forecast'
+    __name__ = 'project.invoice_milestone.forecast'
+    start = StateView('project.invoice_milestone.forecast.start',
+        'project_invoice_milestone.forecast_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Forecast', 'result', 'tryton-ok', default=True),
+            ])
+    result = StateView('project.invoice_milestone.forecast.result',
+        'project_invoice_milestone.forecast_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def default_result(self, fields):
+        pool = Pool()
+        Milestone = pool.get('project.invoice_milestone')
+        Work = pool.get('project.work')
+
+        if Transaction().context.get('active_model') == 'project.work':
+            projects = Work.browse(Transaction().context['active_ids'])
+        else:
+            projects = Work.search([
+                    ('type', '=', 'project'),
+                    ('project_invoice_method', '=', 'milestone'),
+                    ('state', '!=', 'done'),
+                    ])
+        forecasts = Milestone.forecast(projects, self.start.date)
+        projects = dict((p.id, p) for p in Work.browse(
+                list(set(f.project for f in forecasts))))
+        lines = []
+        for forecast in forecasts:
+            project = projects[forecast.project]
+            lines.append({
+                    'milestone': forecast.milestone,
+                    'project': forecast.project,
+                    'party': project.party.id if project.party else None,
+                    'invoice_date': forecast.invoice_date,
+                    'amount': forecast.amount,
+                    'compensation': forecast.compensation,
+                    'total_amount': forecast.amount + forecast.compensation,
+                    })
+        return {
+            'lines': lines,
+            'total_amount': sum((l['total_amount'] for l in lines), _ZERO),
+            }
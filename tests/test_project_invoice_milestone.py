@@ -1,17 +1,167 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 import doctest
+import os
 import unittest
+from decimal import Decimal
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.tests.test_tryton import doctest_setup, doctest_teardown
 from trytond.tests.test_tryton import doctest_checker
+from trytond import backend
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.account.tests import create_chart
+
+
+class QueryCounter(object):
+    'Connection wrapper recording the queries executed by its cursors'
+
+    def __init__(self, connection):
+        self._connection = connection
+        self.queries = []
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def cursor(self, *args, **kwargs):
+        return QueryCounterCursor(
+            self._connection.cursor(*args, **kwargs), self.queries)
+
+
+class QueryCounterCursor(object):
+    'Cursor wrapper recording the queries executed'
+
+    def __init__(self, cursor, queries):
+        self._cursor = cursor
+        self._queries = queries
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, query, *args, **kwargs):
+        self._queries.append(query)
+        return self._cursor.execute(query, *args, **kwargs)
 
 
 class ProjectInvoiceMilestoneTestCase(ModuleTestCase):
     'Test Project Invoice Milestone module'
     module = 'project_invoice_milestone'
 
+    @with_transaction()
+    def test_invoices_without_milestones(self):
+        'Test the milestones queries do not grow with the invoices batch'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Journal = pool.get('account.journal')
+        Party = pool.get('party.party')
+        Invoice = pool.get('account.invoice')
+        transaction = Transaction()
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            receivable, = Account.search([
+                    ('kind', '=', 'receivable'),
+                    ])
+            journal, = Journal.search([
+                    ('type', '=', 'revenue'),
+                    ])
+            party, = Party.create([{
+                        'name': 'Party',
+                        'addresses': [('create', [{}])],
+                        }])
+
+            def milestone_queries(count):
+                invoices = Invoice.create([{
+                            'type': 'out',
+                            'party': party.id,
+                            'invoice_address': party.addresses[0].id,
+                            'account': receivable.id,
+                            'journal': journal.id,
+                            } for _ in range(count)])
+                Invoice.validate_invoice(invoices)
+                invoices = Invoice.browse([i.id for i in invoices])
+
+                connection = transaction.connection
+                transaction.connection = QueryCounter(connection)
+                try:
+                    Invoice.draft(invoices)
+                    Invoice.delete(invoices)
+                    queries = transaction.connection.queries
+                finally:
+                    transaction.connection = connection
+                return len([q for q in queries
+                        if 'project_invoice_milestone' in q])
+
+            queries = milestone_queries(3)
+            self.assertTrue(queries)
+            self.assertEqual(milestone_queries(30), queries)
+
+    @unittest.skipIf(backend.name() != 'postgresql',
+        'Query plans are checked only on PostgreSQL')
+    @with_transaction()
+    def test_pending_trigger_query_plan(self):
+        'Test the cron query of pending triggers uses the partial index'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Work = pool.get('project.work')
+        Milestone = pool.get('project.invoice_milestone')
+        cursor = Transaction().connection.cursor()
+
+        company = create_company()
+        with set_company(company):
+            party, = Party.create([{
+                        'name': 'Party',
+                        }])
+            project, = Work.create([{
+                        'name': 'Project',
+                        'type': 'project',
+                        'company': company.id,
+                        'party': party.id,
+                        'project_invoice_method': 'milestone',
+                        }])
+            milestone, = Milestone.create([{
+                        'project': project.id,
+                        'kind': 'manual',
+                        'invoice_method': 'percent',
+                        'invoice_percent': Decimal('0.1'),
+                        }])
+
+            # Fill the table mostly with milestones not pending to trigger
+            table = Milestone._table
+            cursor.execute('SELECT * FROM "%s" LIMIT 0' % table)
+            columns = [c[0] for c in cursor.description
+                if c[0] not in {'id', 'number', 'kind', 'state'}]
+            cursor.execute('INSERT INTO "%s" (%s, kind, state) '
+                'SELECT %s, '
+                "CASE WHEN s %% 4 = 0 THEN 'system' ELSE 'manual' END, "
+                "CASE WHEN s %% 100 = 0 THEN 'confirmed' "
+                "WHEN s %% 3 = 0 THEN 'draft' ELSE 'invoiced' END "
+                'FROM "%s", generate_series(1, 50000) AS s '
+                'WHERE id = %%s' % (table,
+                    ', '.join('"%s"' % c for c in columns),
+                    ', '.join('"%s"' % c for c in columns), table),
+                (milestone.id,))
+            cursor.execute('ANALYZE "%s"' % table)
+
+            query = Milestone.search(
+                Milestone._get_pending_trigger_domain([]) + [
+                    ('project_company', '=', company.id),
+                    ('id', '>', 0),
+                    ], order=[('id', 'ASC')], limit=100, query=True)
+            sql, params = tuple(query)
+            cursor.execute('EXPLAIN ' + sql, params)
+            plan = '\n'.join(r[0] for r in cursor.fetchall())
+            self.assertIn(
+                'project_invoice_milestone_pending_trigger_company_index',
+                plan)
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
@@ -22,4 +172,22 @@ def suite():
             setUp=doctest_setup, tearDown=doctest_teardown, encoding='utf-8',
             checker=doctest_checker,
             optionflags=doctest.REPORT_ONLY_FIRST_FAILURE))
+    suite.addTests(doctest.DocFileSuite(
+            'scenario_project_invoice_milestone_trigger_shards.rst',
+            setUp=doctest_setup, tearDown=doctest_teardown, encoding='utf-8',
+            checker=doctest_checker,
+            optionflags=doctest.REPORT_ONLY_FIRST_FAILURE))
+    if os.environ.get('BENCHMARK'):
+        # Slow and timing dependent, run only on demand
+        suite.addTests(doctest.DocFileSuite(
+                'scenario_project_invoice_milestone_benchmark.rst',
+                setUp=doctest_setup, tearDown=doctest_teardown,
+                encoding='utf-8', checker=doctest_checker,
+                optionflags=doctest.REPORT_ONLY_FIRST_FAILURE))
+    if backend.name() == 'postgresql':
+        suite.addTests(doctest.DocFileSuite(
+                'scenario_project_invoice_milestone_concurrency.rst',
+                setUp=doctest_setup, tearDown=doctest_teardown,
+                encoding='utf-8', checker=doctest_checker,
+                optionflags=doctest.REPORT_ONLY_FIRST_FAILURE))
     return suite
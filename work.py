@@ -1,12 +1,24 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 import datetime
+import logging
 from decimal import Decimal
+from sql import Null
+from sql.aggregate import Min, Sum
+from sql.conditionals import Coalesce
+
+from trytond import backend
 from trytond.model import fields, ModelView
 from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Bool, Eval, Or
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateView, StateTransition, Button
+
+__all__ = ['Work', 'WorkInvoicedProgress', 'CheckCompensationLedger',
+    'CreateMilestonesStart', 'CreateMilestones']
 
-__all__ = ['Work', 'WorkInvoicedProgress']
+logger = logging.getLogger(__name__)
 
 
 DRAFT_STATES = {
@@ -18,6 +30,15 @@ OPENED_STATES = {
 DEPENDS = ['state']
 
 
+def _duration_hours(duration):
+    if not duration:
+        return 0
+    if isinstance(duration, datetime.timedelta):
+        return duration.total_seconds() / 3600
+    # Some backends return the sum of intervals as seconds
+    return float(duration) / 3600
+
+
 def update_states(field, new_states, key):
     assert key in new_states
     if field.states and key in field.states:
@@ -48,6 +69,28 @@ class Work:
             'readonly': Eval('state') == 'done',
             },
         depends=['type', 'project_invoice_method', 'state'])
+    milestone_progress_threshold = fields.Numeric(
+        'Milestone Progress Threshold', digits=(16, 8), readonly=True,
+        help='The lowest progress that triggers a pending milestone of the '
+        'project.')
+    milestone_advanced_amount = fields.Numeric('Milestone Advanced Amount',
+        digits=(16, 2), readonly=True,
+        help='The amount invoiced by the fixed milestones of the project.')
+    milestone_compensated_amount = fields.Numeric(
+        'Milestone Compensated Amount', digits=(16, 2), readonly=True,
+        help='The advanced amount already compensated by the other '
+        'milestones of the project.')
+    pending_to_compensate_amount = fields.Function(fields.Numeric(
+            'Pending to Compensate', digits=(16, 2),
+            help='The advanced amount not compensated yet by milestones.'),
+        'get_pending_to_compensate_amount')
+    invoiced_progress_quantity = fields.Float('Invoiced Progress Quantity',
+        readonly=True,
+        help='The sum of the quantity of the invoiced progress of the work.')
+    invoiced_progress_hours = fields.Float('Invoiced Progress Hours',
+        readonly=True,
+        help='The sum of the effort hours of the invoiced progress of the '
+        'work.')
 
     @classmethod
     def __setup__(cls):
@@ -117,6 +160,120 @@ class Work:
                     ' "%s" and Invoice Product Type "%s"'),
                 })
 
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Milestone = pool.get('project.invoice_milestone')
+        InvoicedProgress = pool.get('project.work.invoiced_progress')
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        milestone = Milestone.__table__()
+        invoiced_progress = InvoicedProgress.__table__()
+
+        table_h = TableHandler(cls, module_name)
+        fill_threshold = not table_h.column_exist(
+            'milestone_progress_threshold')
+        fill_invoiced_progress = not table_h.column_exist(
+            'invoiced_progress_quantity')
+        fill_compensation_ledger = not table_h.column_exist(
+            'milestone_advanced_amount')
+
+        super(Work, cls).__register__(module_name)
+
+        if fill_invoiced_progress:
+            cursor.execute(*invoiced_progress.select(
+                    invoiced_progress.work,
+                    Sum(Coalesce(invoiced_progress.quantity, 0)),
+                    Sum(invoiced_progress.effort_duration),
+                    group_by=invoiced_progress.work))
+            for work_id, quantity, duration in cursor.fetchall():
+                cls._update_invoiced_progress_ledger(
+                    {work_id: (quantity, _duration_hours(duration))})
+
+        if fill_threshold:
+            pending = milestone.select(Min(milestone.trigger_progress),
+                where=((milestone.project == table.id)
+                    & (milestone.state == 'confirmed')
+                    & (milestone.kind == 'system')
+                    & (milestone.trigger == 'progress')
+                    & (milestone.invoice == Null)))
+            cursor.execute(*table.update(
+                    [table.milestone_progress_threshold], [pending]))
+
+        if fill_compensation_ledger:
+            cursor.execute(*table.select(table.id,
+                    where=((table.type == 'project')
+                        & (table.project_invoice_method == 'milestone'))))
+            for sub_ids in grouped_slice([i for i, in cursor.fetchall()]):
+                cls.update_compensation_ledger(cls.browse(sub_ids))
+
+    @classmethod
+    def update_milestone_progress_threshold(cls, projects):
+        """Store in projects the lowest trigger progress of their confirmed,
+        not invoiced, system milestones."""
+        pool = Pool()
+        Milestone = pool.get('project.invoice_milestone')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        thresholds = dict.fromkeys(p.id for p in projects)
+        with Transaction().set_user(0):
+            for sub_ids in grouped_slice(thresholds.keys()):
+                for milestone in Milestone.search([
+                            ('project', 'in', list(sub_ids)),
+                            ('state', '=', 'confirmed'),
+                            ('kind', '=', 'system'),
+                            ('trigger', '=', 'progress'),
+                            ('invoice', '=', None),
+                            ]):
+                    project_id = milestone.project.id
+                    threshold = thresholds[project_id]
+                    if (threshold is None
+                            or milestone.trigger_progress < threshold):
+                        thresholds[project_id] = milestone.trigger_progress
+
+        by_threshold = {}
+        for project_id, threshold in thresholds.iteritems():
+            by_threshold.setdefault(threshold, []).append(project_id)
+        for threshold, project_ids in by_threshold.iteritems():
+            for sub_ids in grouped_slice(project_ids):
+                cursor.execute(*table.update(
+                        [table.milestone_progress_threshold], [threshold],
+                        where=reduce_ids(table.id, sub_ids)))
+        cls._reset_cache(thresholds.keys())
+
+    @classmethod
+    def _reset_cache(cls, ids):
+        "Invalidate the cached values of works updated with SQL queries"
+        transaction = Transaction()
+        transaction.counter += 1
+        for cache in transaction.cache.itervalues():
+            if cls.__name__ in cache:
+                for id_ in ids:
+                    cache[cls.__name__].pop(id_, None)
+
+    @classmethod
+    def _update_invoiced_progress_ledger(cls, deltas):
+        """Add to the invoiced progress quantity and hours of each work the
+        (quantity, hours) of deltas, a dictionary by work id."""
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        for work_id, (quantity, hours) in deltas.iteritems():
+            if not quantity and not hours:
+                continue
+            cursor.execute(*table.update([
+                        table.invoiced_progress_quantity,
+                        table.invoiced_progress_hours,
+                        ], [
+                        Coalesce(table.invoiced_progress_quantity, 0)
+                        + (quantity or 0),
+                        Coalesce(table.invoiced_progress_hours, 0)
+                        + (hours or 0),
+                        ],
+                    where=table.id == work_id))
+        cls._reset_cache(deltas.keys())
+
     @classmethod
     def validate(cls, works):
         super(Work, cls).validate(works)
@@ -163,6 +320,7 @@ class Work:
         for work in works:
             milestones += work.milestones
         Milestone.check_trigger(milestones)
+        cls._enqueue_milestone_triggers(works)
 
     @classmethod
     @ModelView.button
@@ -181,59 +339,182 @@ class Work:
                             })
             milestones += work.milestones
         Milestone.check_trigger(milestones)
+        cls._enqueue_milestone_triggers(works)
+
+    @classmethod
+    def _milestone_trigger_fields(cls):
+        "Fields whose change may fulfill the trigger of a project milestone"
+        return {'progress', 'effort_duration', 'quantity', 'progress_quantity'}
+
+    @classmethod
+    def _enqueue_milestone_triggers(cls, works, progress=False):
+        """Enqueue the milestone projects of works (and their ancestors) to
+        be checked by the milestone triggers cron.
+        If progress is set, only the projects whose progress reached the
+        threshold of a pending milestone are enqueued."""
+        Queue = Pool().get('project.invoice_milestone.trigger.queue')
+        if not works:
+            return
+        domain = [
+            ('parent', 'parent_of', [w.id for w in works]),
+            ('type', '=', 'project'),
+            ('project_invoice_method', '=', 'milestone'),
+            ]
+        if progress:
+            domain.append(('milestone_progress_threshold', '!=', None))
+        projects = cls.search(domain)
+        if progress:
+            projects = [p for p in projects
+                if (p.percent_progress_amount
+                    >= p.milestone_progress_threshold)]
+        Queue.enqueue(projects)
 
     @classmethod
     @ModelView.button
-    def create_milestone(cls, works):
-        Milestone = Pool().get('project.invoice_milestone')
+    def create_milestone(cls, works, group=None):
+        """Create the milestones of works without milestones from their group
+        or the given one."""
+        MilestoneTypeGroup = Pool().get(
+            'project.invoice_milestone.type.group')
 
-        milestones = []
+        project_groups = []
         for work in works:
-            if not work.milestone_group_type or work.milestones:
+            work_group = group or work.milestone_group_type
+            if not work_group or work.milestones:
                 continue
-            milestones += work.milestone_group_type.compute(work)
-        Milestone.save(milestones)
+            project_groups.append((work, work_group))
+        MilestoneTypeGroup.create_milestones(project_groups)
 
     @property
     def pending_to_compensate_advanced_amount(self):
-        InvoiceLine = Pool().get('account.invoice.line')
-
-        advanced_amount = Decimal(0)
-        invoice_ids = []
-        milestone_ids = []
-        compensation_products = set()
-        for milestone in self.milestones:
-            if not milestone.invoice or milestone.invoice.state == 'cancel':
-                continue
-            if milestone.invoice_method == 'fixed':
-                if milestone.is_credit:
-                    # If it's necessary to get the invoice line amount, save
-                    # relation to inv line on Milestone._credit()
-                    advanced_amount += milestone.advancement_amount
+        # The ledger is empty until a milestone of the project is invoiced
+        return ((self.milestone_advanced_amount or Decimal(0))
+            - (self.milestone_compensated_amount or Decimal(0)))
+
+    @classmethod
+    def update_compensation_ledger(cls, projects):
+        "Store the advanced and compensated amounts of projects"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        ledger = cls._compute_compensation_ledger(projects)
+        for project_id, (advanced, compensated) in ledger.iteritems():
+            cursor.execute(*table.update([
+                        table.milestone_advanced_amount,
+                        table.milestone_compensated_amount,
+                        ], [advanced, compensated],
+                    where=table.id == project_id))
+        cls._reset_cache(ledger.keys())
+
+    @classmethod
+    def get_pending_to_compensate_amounts(cls, projects):
+        """Return the advanced amount pending to compensate of each project
+        id, computed from the invoices with a fixed number of queries."""
+        ledger = cls._compute_compensation_ledger(projects)
+        return dict((p, advanced - compensated)
+            for p, (advanced, compensated) in ledger.iteritems())
+
+    @classmethod
+    def get_pending_to_compensate_amount(cls, works, name):
+        return cls.get_pending_to_compensate_amounts(works)
+
+    @classmethod
+    def _compute_compensation_ledger(cls, projects):
+        """Return the advanced and compensated amounts of each project id.
+
+        The advanced amount is the amount invoiced by fixed milestones and the
+        compensated one the amount of the compensation lines of the other
+        milestones."""
+        pool = Pool()
+        Milestone = pool.get('project.invoice_milestone')
+        Invoice = pool.get('account.invoice')
+        milestone = Milestone.__table__()
+        invoice = Invoice.__table__()
+        cursor = Transaction().connection.cursor()
+
+        project_ids = [p.id for p in projects]
+        milestones = {}
+        for sub_ids in grouped_slice(project_ids):
+            cursor.execute(*milestone.join(invoice,
+                    condition=invoice.id == milestone.invoice
+                    ).select(milestone.project, milestone.id,
+                    milestone.invoice_method, milestone.is_credit,
+                    milestone.advancement_amount,
+                    milestone.compensation_product, milestone.invoice,
+                    where=(reduce_ids(milestone.project, sub_ids)
+                        & (invoice.state != 'cancel'))))
+            for row in cursor.fetchall():
+                milestones.setdefault(row[0], []).append(row[1:])
+
+        milestones_count, lines = Milestone._get_invoice_line_amounts(
+            list(set(r[-1] for rows in milestones.itervalues()
+                    for r in rows)))
+
+        ledger = {}
+        for project_id in project_ids:
+            advanced_amount = Decimal(0)
+            invoice_ids = set()
+            origins = set()
+            compensation_products = set()
+            for (milestone_id, invoice_method, is_credit, advancement_amount,
+                    compensation_product, invoice_id) in milestones.get(
+                        project_id, []):
+                origin = 'project.invoice_milestone,%s' % milestone_id
+                if invoice_method == 'fixed':
+                    if is_credit:
+                        # If it's necessary to get the invoice line amount,
+                        # save relation to inv line on Milestone._credit()
+                        advanced_amount += advancement_amount
+                    elif milestones_count.get(invoice_id, 0) <= 1:
+                        advanced_amount += sum((a
+                                for _, _, a in lines.get(invoice_id, [])),
+                            Decimal(0))
+                    else:
+                        # Consolidated invoice
+                        advanced_amount += sum((a
+                                for o, _, a in lines.get(invoice_id, [])
+                                if o == origin), Decimal(0))
                 else:
-                    advanced_amount += milestone.invoice.untaxed_amount
-            else:
-                invoice_ids.append(milestone.invoice.id)
-                milestone_ids.append(milestone.id)
-            if milestone.compensation_product:
-                compensation_products.add(milestone.compensation_product.id)
-
-        if (advanced_amount == Decimal(0) or not milestone_ids
-                or not compensation_products):
-            return advanced_amount
-
-        # Get all compensation lines (origin is project's milestones)
-        compensation_inv_lines = InvoiceLine.search([
-                ('invoice', 'in', invoice_ids),
-                ('origin.id', 'in', milestone_ids,
-                    'project.invoice_milestone'),
-                ('product', 'in', list(compensation_products)),
-                ])
-        if not compensation_inv_lines:
-            return advanced_amount
+                    invoice_ids.add(invoice_id)
+                    origins.add(origin)
+                if compensation_product:
+                    compensation_products.add(compensation_product)
+
+            compensated_amount = Decimal(0)
+            if (advanced_amount != Decimal(0) and origins
+                    and compensation_products):
+                # Compensation lines (origin is project's milestones)
+                compensated_amount = -sum((a for i in invoice_ids
+                        for o, p, a in lines.get(i, [])
+                        if o in origins and p in compensation_products),
+                    Decimal(0))
+            ledger[project_id] = (advanced_amount, compensated_amount)
+        return ledger
 
-        return (advanced_amount
-            + sum(il.amount for il in compensation_inv_lines))
+    @classmethod
+    def check_compensation_ledger(cls, projects=None):
+        """Rebuild from scratch the compensation ledger of projects (all the
+        milestone projects by default) and return the projects whose stored
+        amounts were wrong."""
+        if projects is None:
+            projects = cls.search([
+                    ('type', '=', 'project'),
+                    ('project_invoice_method', '=', 'milestone'),
+                    ])
+        wrong = []
+        for sub_projects in grouped_slice(projects):
+            sub_projects = cls.browse([p.id for p in sub_projects])
+            ledger = cls._compute_compensation_ledger(sub_projects)
+            for project in sub_projects:
+                if ((project.milestone_advanced_amount or Decimal(0),
+                            project.milestone_compensated_amount
+                            or Decimal(0))
+                        != ledger[project.id]):
+                    logger.warning('Wrong compensation ledger of project %s',
+                        project.id)
+                    wrong.append(project)
+            cls.update_compensation_ledger(sub_projects)
+        return wrong
 
     def get_invoice_method(self, name):
         """Milestone invoice method is like progress but invoicing triggered
@@ -251,15 +532,12 @@ class Work:
             return []
 
         if self.invoice_product_type == 'service':
-            invoiced_progress = sum(x.effort_hours
-                for x in self.invoiced_progress)
-            quantity = self.effort_hours - invoiced_progress
+            quantity = self.effort_hours - (self.invoiced_progress_hours or 0)
             product = self.product
             invoiced_progress = InvoicedProgress(work=self,
                 effort_duration=datetime.timedelta(hours=quantity))
         elif self.invoice_product_type == 'goods':
-            invoiced_quantity = sum(x.quantity for x in self.invoiced_progress)
-            quantity = self.quantity - invoiced_quantity
+            quantity = self.quantity - (self.invoiced_progress_quantity or 0)
             product = self.product_goods
             invoiced_progress = InvoicedProgress(work=self,
                 quantity=quantity)
@@ -293,6 +571,25 @@ class Work:
                 vals['state'] = 'opened'
         return super(Work, cls).create(vlist)
 
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Milestone = pool.get('project.invoice_milestone')
+        super(Work, cls).write(*args)
+
+        trigger_fields = cls._milestone_trigger_fields()
+        to_enqueue = []
+        to_sync = []
+        actions = iter(args)
+        for works, values in zip(actions, actions):
+            if trigger_fields & set(values):
+                to_enqueue.extend(works)
+            if {'company', 'party'} & set(values):
+                to_sync.extend(w for w in works if w.type == 'project')
+        cls._enqueue_milestone_triggers(to_enqueue, progress=True)
+        if to_sync:
+            Milestone.sync_project_fields(to_sync)
+
     @classmethod
     def copy(cls, works, default=None):
         if default is None:
@@ -300,6 +597,11 @@ class Work:
         else:
             default = default.copy()
         default['milestones'] = None
+        default.setdefault('milestone_progress_threshold', None)
+        default.setdefault('invoiced_progress_quantity', None)
+        default.setdefault('invoiced_progress_hours', None)
+        default.setdefault('milestone_advanced_amount', None)
+        default.setdefault('milestone_compensated_amount', None)
         if default.get('type', '') == 'project':
             default['state'] = 'draft'
         else:
@@ -311,6 +613,47 @@ class WorkInvoicedProgress:
     __metaclass__ = PoolMeta
     __name__ = 'project.work.invoiced_progress'
 
+    @classmethod
+    def create(cls, vlist):
+        Work = Pool().get('project.work')
+        records = super(WorkInvoicedProgress, cls).create(vlist)
+        Work._update_invoiced_progress_ledger(cls._ledger_deltas(records))
+        Work._enqueue_milestone_triggers([r.work for r in records],
+            progress=True)
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        Work = Pool().get('project.work')
+        records = sum(args[::2], [])
+        old_deltas = cls._ledger_deltas(records, sign=-1)
+        super(WorkInvoicedProgress, cls).write(*args)
+        records = cls.browse([r.id for r in records])
+        Work._update_invoiced_progress_ledger(old_deltas)
+        Work._update_invoiced_progress_ledger(cls._ledger_deltas(records))
+        Work._enqueue_milestone_triggers([r.work for r in records],
+            progress=True)
+
+    @classmethod
+    def delete(cls, records):
+        Work = Pool().get('project.work')
+        works = [r.work for r in records]
+        deltas = cls._ledger_deltas(records, sign=-1)
+        super(WorkInvoicedProgress, cls).delete(records)
+        Work._update_invoiced_progress_ledger(deltas)
+        Work._enqueue_milestone_triggers(works, progress=True)
+
+    @staticmethod
+    def _ledger_deltas(records, sign=1):
+        "Return the (quantity, hours) of records by work id"
+        deltas = {}
+        for record in records:
+            quantity, hours = deltas.get(record.work.id, (0, 0))
+            deltas[record.work.id] = (
+                quantity + sign * (record.quantity or 0),
+                hours + sign * _duration_hours(record.effort_duration))
+        return deltas
+
     def _credit(self):
         '''
         Return values to credit invoiced progress.
@@ -323,3 +666,51 @@ class WorkInvoicedProgress:
             invoiced_progress.quantity = -self.quantity
         # invoiced_progress.invoice_line'] = credit invoice line
         return invoiced_progress
+
+
+class CheckCompensationLedger(Wizard):
+    'Check Compensation Ledger'
+    __name__ = 'project.work.check_compensation_ledger'
+    start_state = 'check'
+    check = StateTransition()
+
+    def transition_check(self):
+        pool = Pool()
+        Work = pool.get('project.work')
+
+        projects = None
+        if Transaction().context.get('active_model') == 'project.work':
+            projects = Work.browse(Transaction().context['active_ids'])
+        Work.check_compensation_ledger(projects)
+        return 'end'
+
+
+class CreateMilestonesStart(ModelView):
+    'Create Milestones Start'
+    __name__ = 'project.work.create_milestones.start'
+    group = fields.Many2One('project.invoice_milestone.type.group',
+        'Milestone Group Type',
+        help='Leave empty to use the milestone group type of each project.')
+
+
+class CreateMilestones(Wizard):
+    'Create Milestones'
+    __name__ = 'project.work.create_milestones'
+    start = StateView('project.work.create_milestones.start',
+        'project_invoice_milestone.create_milestones_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Create', 'create_', 'tryton-ok', default=True),
+            ])
+    create_ = StateTransition()
+
+    def transition_create_(self):
+        pool = Pool()
+        Work = pool.get('project.work')
+
+        works = Work.search([
+                ('id', 'in', Transaction().context['active_ids']),
+                ('type', '=', 'project'),
+                ('project_invoice_method', '=', 'milestone'),
+                ])
+        Work.create_milestone(works, group=self.start.group)
+        return 'end'